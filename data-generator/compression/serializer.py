@@ -1,69 +1,236 @@
 from __future__ import annotations
 
 import json
+import os
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from pathlib import Path
 from typing import Any
 
 import numpy as np
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib encoder.
+    orjson = None
+
+
+def _json_default(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def encode_json(payload: Any, indent: bool = True) -> bytes:
+    if orjson is not None:
+        option = orjson.OPT_SERIALIZE_NUMPY
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(payload, default=_json_default, option=option)
+    if indent:
+        return json.dumps(payload, indent=2, default=_json_default).encode("utf-8")
+    return json.dumps(payload, separators=(",", ":"), default=_json_default).encode("utf-8")
+
+
+_SAFETENSORS_DTYPES = {
+    np.dtype(np.float16): "F16",
+    np.dtype(np.float32): "F32",
+}
+
+
+def open_safetensors_memmap(
+    path: str | Path,
+    tensors: dict[str, tuple[tuple[int, ...], Any]],
+) -> dict[str, np.memmap]:
+    # Writes a valid safetensors header up front and maps each tensor's data range,
+    # so rows can be filled in place while the run is still going.
+    header: dict[str, Any] = {}
+    data_bytes = 0
+    for name, (shape, dtype) in tensors.items():
+        nbytes = int(np.prod(shape)) * np.dtype(dtype).itemsize
+        header[name] = {
+            "dtype": _SAFETENSORS_DTYPES[np.dtype(dtype)],
+            "shape": list(shape),
+            "data_offsets": [data_bytes, data_bytes + nbytes],
+        }
+        data_bytes += nbytes
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * (-len(header_bytes) % 8)
+    data_start = 8 + len(header_bytes)
+
+    path = Path(path)
+    with path.open("wb") as handle:
+        handle.write(struct.pack("<Q", len(header_bytes)))
+        handle.write(header_bytes)
+        handle.truncate(data_start + data_bytes)
+
+    return {
+        name: np.memmap(
+            path,
+            dtype=np.dtype(dtype).newbyteorder("<"),
+            mode="r+",
+            offset=data_start + header[name]["data_offsets"][0],
+            shape=tuple(shape),
+        )
+        for name, (shape, dtype) in tensors.items()
+    }
+
+
+def scan_file_sizes(root: str | Path):
+    # DirEntry caches type info from readdir, so each file costs a single stat.
+    stack = [os.fspath(root)]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.stat(follow_symlinks=False).st_size
+
+
+# Storage dtypes allowed for attention maps, keyed by the name recorded in metadata.
+ATTENTION_DTYPES = {
+    "float16": np.dtype(np.float16),
+    "uint8": np.dtype(np.uint8),
+}
+_ATTENTION_DTYPE_NAMES = {dtype: name for name, dtype in ATTENTION_DTYPES.items()}
+
+
+def valid_attention_scale(attention_type: str, shape: list[int], scale: Any) -> bool:
+    # Cross maps carry one scale per token slice, self maps a single scale.
+    def positive(value: Any) -> bool:
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and value > 0
+
+    if attention_type == "cross":
+        return isinstance(scale, list) and len(scale) == shape[0] and all(positive(v) for v in scale)
+    return positive(scale)
+
 
 class DatasetSerializer:
     def __init__(self, output_dir: str | Path) -> None:
         self.output_dir = Path(output_dir)
         self.images_dir = self.output_dir / "images"
         self.attention_dir = self.output_dir / "attention"
-        self.cross_attention_dir = self.attention_dir / "cross"
-        self.self_attention_dir = self.attention_dir / "self"
+        self.attention_path = self.attention_dir / "attention.bin"
 
         self.images_dir.mkdir(parents=True, exist_ok=True)
-        self.cross_attention_dir.mkdir(parents=True, exist_ok=True)
-        self.self_attention_dir.mkdir(parents=True, exist_ok=True)
+        self.attention_dir.mkdir(parents=True, exist_ok=True)
+
+        # All attention maps are appended to one blob; metadata records byte offsets into it.
+        self._attention_fh = open(self.attention_path, "wb", buffering=1 << 20)
+        self._attention_offset = 0
 
         self.attention_files: list[dict[str, Any]] = []
         self.image_paths: list[str] = []
 
+        # PNG encoding releases the GIL inside zlib, so it overlaps with the next UNet step.
+        self._pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="png-encode")
+        self._futures: list[Future] = []
+
     def save_image(self, step: int, image) -> str:
         file_name = f"step_{step:03d}.png"
         path = self.images_dir / file_name
-        image.save(path, format="PNG", optimize=True)
+        # Still a standard PNG; only the encoder's filter/zlib search is trimmed.
+        self._futures.append(
+            self._pool.submit(image.save, path, format="PNG", optimize=False, compress_level=1)
+        )
         rel = str(path.relative_to(self.output_dir))
         self.image_paths.append(rel)
         return rel
 
-    def save_attention(self, step: int, layer_id: str, attention_type: str, array: np.ndarray) -> dict:
-        if array.dtype != np.float16:
-            array = array.astype(np.float16)
-
-        file_name = f"{layer_id}_step_{step:03d}.bin"
-        if attention_type == "cross":
-            path = self.cross_attention_dir / file_name
-        elif attention_type == "self":
-            path = self.self_attention_dir / file_name
-        else:
+    def _attention_record(
+        self,
+        step: int,
+        layer_id: str,
+        attention_type: str,
+        array: np.ndarray,
+        scale: float | list[float] | None = None,
+    ) -> dict:
+        if attention_type not in {"cross", "self"}:
             raise ValueError(f"Unsupported attention type: {attention_type}")
-        array.tofile(path)
+        # The recorder hands over fp16 or quantized uint8 maps; refuse silently re-casting anything else.
+        dtype_name = _ATTENTION_DTYPE_NAMES.get(array.dtype)
+        if dtype_name is None:
+            raise ValueError(f"Attention map {layer_id} must be float16 or uint8, got {array.dtype}")
+        if dtype_name == "uint8" and scale is None:
+            raise ValueError(f"Quantized attention map {layer_id} needs a scale")
 
         record = {
             "step": step,
             "layer_id": layer_id,
             "attention_type": attention_type,
-            "path": str(path.relative_to(self.output_dir)),
+            "path": str(self.attention_path.relative_to(self.output_dir)),
+            "offset": self._attention_offset,
+            "nbytes": array.nbytes,
             "shape": list(array.shape),
-            "dtype": "float16",
+            "dtype": dtype_name,
         }
+        if scale is not None:
+            record["scale"] = [float(v) for v in scale] if attention_type == "cross" else float(scale)
+        self._attention_offset += array.nbytes
+        return record
+
+    def save_attention(
+        self,
+        step: int,
+        layer_id: str,
+        attention_type: str,
+        array: np.ndarray,
+        scale: float | list[float] | None = None,
+    ) -> dict:
+        array = np.ascontiguousarray(array)
+        record = self._attention_record(step, layer_id, attention_type, array, scale)
+        self._attention_fh.write(memoryview(array).cast("B"))
         self.attention_files.append(record)
         return record
 
-    def write_json(self, path: str | Path, payload: dict[str, Any]) -> None:
+    def save_attention_bundle(
+        self,
+        step: int,
+        cross_maps: dict[str, np.ndarray],
+        self_maps: dict[str, np.ndarray],
+        cross_scales: dict[str, list[float]] | None = None,
+        self_scales: dict[str, float] | None = None,
+    ) -> list[dict]:
+        records: list[dict] = []
+        chunks: list[memoryview] = []
+        for attention_type, maps, scales in (
+            ("cross", cross_maps, cross_scales or {}),
+            ("self", self_maps, self_scales or {}),
+        ):
+            for layer_id, array in maps.items():
+                array = np.ascontiguousarray(array)
+                records.append(
+                    self._attention_record(step, layer_id, attention_type, array, scales.get(layer_id))
+                )
+                chunks.append(memoryview(array).cast("B"))
+
+        self._attention_fh.writelines(chunks)
+        self.attention_files.extend(records)
+        return records
+
+    def flush(self) -> None:
+        futures, self._futures = self._futures, []
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def close(self) -> None:
+        try:
+            self.flush()
+        finally:
+            self._pool.shutdown(wait=True)
+            self._attention_fh.close()
+
+    def write_json(self, path: str | Path, payload: dict[str, Any], indent: bool = True) -> None:
         target = self.output_dir / path
         target.parent.mkdir(parents=True, exist_ok=True)
         temp_target = target.with_suffix(f"{target.suffix}.tmp")
-        temp_target.write_text(json.dumps(payload, indent=2, sort_keys=True), encoding="utf-8")
+        temp_target.write_bytes(encode_json(payload, indent=indent))
         temp_target.replace(target)
 
     def dataset_size_bytes(self) -> int:
-        total = 0
-        for file in self.output_dir.rglob("*"):
-            if file.is_file():
-                total += file.stat().st_size
-        return total
+        return sum(scan_file_sizes(self.output_dir))
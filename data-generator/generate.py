@@ -3,21 +3,27 @@ from __future__ import annotations
 import argparse
 import json
 import shutil
+import time
 from pathlib import Path
 from typing import Any, Literal
 
 import numpy as np
 import torch
+import torch.nn.functional as F
 from diffusers import StableDiffusionPipeline, StableDiffusionXLPipeline
 from tqdm import tqdm
 
-from compression.serializer import DatasetSerializer
+from compression.serializer import (
+    ATTENTION_DTYPES,
+    DatasetSerializer,
+    encode_json,
+    open_safetensors_memmap,
+    valid_attention_scale,
+)
 from hooks.attention_recorder import AttentionRecorder, create_recording_processors
 from metrics.analytics import (
     compute_latent_pca,
-    cosine_similarity,
-    kl_divergence,
-    latent_l2_norm,
+    stepwise_kl_divergence,
     token_importance_ranking,
 )
 
@@ -54,8 +60,21 @@ def parse_args() -> argparse.Namespace:
     )
     parser.add_argument("--attention-resolution", type=int, default=32)
     parser.add_argument("--self-attention-resolution", type=int, default=32)
+    parser.add_argument(
+        "--attention-dtype",
+        type=str,
+        choices=list(ATTENTION_DTYPES),
+        default="float16",
+        help="Storage dtype for attention maps; uint8 is linearly quantized with per-token (cross) or per-map (self) scales.",
+    )
     parser.add_argument("--device", type=str, choices=["auto", "cuda", "cpu", "mps"], default="auto")
     parser.add_argument("--dtype", type=str, choices=["float16", "float32"], default="float16")
+    parser.add_argument(
+        "--compile-unet",
+        action=argparse.BooleanOptionalAction,
+        default=False,
+        help="Compile the UNet and the recorder's per-layer reductions with torch.compile.",
+    )
     parser.add_argument(
         "--save-latents-noise",
         action=argparse.BooleanOptionalAction,
@@ -241,11 +260,6 @@ def build_tokens(tokenizer, prompt: str) -> tuple[list[str], list[int]]:
     return tokens, ids
 
 
-def normalize_distribution(values: np.ndarray) -> np.ndarray:
-    v = np.clip(values.astype(np.float64), 1e-8, None)
-    return v / v.sum()
-
-
 def infer_meaningful_token_count(
     tokens: list[str],
     token_ids: list[int],
@@ -276,37 +290,55 @@ def infer_meaningful_token_count(
     return max(1, min(count, len(tokens)))
 
 
-def write_progress(
-    progress_file: Path | None,
-    stage: str,
-    message: str,
-    current_step: int | None = None,
-    total_steps: int | None = None,
-    dataset_path: str | None = None,
-    error: str | None = None,
-) -> None:
-    if progress_file is None:
-        return
-
-    payload: dict[str, Any] = {
-        "stage": stage,
-        "message": message,
-        "current_step": current_step,
-        "total_steps": total_steps,
-        "percent": None,
-        "dataset_path": dataset_path,
-        "error": error,
-    }
+class ProgressWriter:
+    def __init__(self, progress_file: Path | None, min_interval_s: float = 0.25) -> None:
+        self.progress_file = progress_file
+        self.min_interval_s = min_interval_s
+        self._last_stage: str | None = None
+        self._last_write_ts = float("-inf")
+
+    def write(
+        self,
+        stage: str,
+        message: str,
+        current_step: int | None = None,
+        total_steps: int | None = None,
+        dataset_path: str | None = None,
+        error: str | None = None,
+    ) -> None:
+        if self.progress_file is None:
+            return
+
+        # Within a stage, intermediate step updates are rate-limited; stage changes and the last step always land.
+        now = time.monotonic()
+        if (
+            stage == self._last_stage
+            and current_step != total_steps
+            and now - self._last_write_ts < self.min_interval_s
+        ):
+            return
+        self._last_stage = stage
+        self._last_write_ts = now
+
+        payload: dict[str, Any] = {
+            "stage": stage,
+            "message": message,
+            "current_step": current_step,
+            "total_steps": total_steps,
+            "percent": None,
+            "dataset_path": dataset_path,
+            "error": error,
+        }
 
-    if (
-        isinstance(current_step, int)
-        and isinstance(total_steps, int)
-        and total_steps > 0
-    ):
-        payload["percent"] = round((current_step / total_steps) * 100.0, 2)
+        if (
+            isinstance(current_step, int)
+            and isinstance(total_steps, int)
+            and total_steps > 0
+        ):
+            payload["percent"] = round((current_step / total_steps) * 100.0, 2)
 
-    progress_file.parent.mkdir(parents=True, exist_ok=True)
-    progress_file.write_text(json.dumps(payload, indent=2), encoding="utf-8")
+        self.progress_file.parent.mkdir(parents=True, exist_ok=True)
+        self.progress_file.write_bytes(encode_json(payload, indent=False))
 
 
 def prepare_output_dir(output_dir: Path, overwrite_output: bool) -> None:
@@ -326,6 +358,7 @@ def prepare_output_dir(output_dir: Path, overwrite_output: bool) -> None:
 def validate_attention_assets(output_dir: Path, attention_files: list[dict[str, Any]]) -> dict[str, Any]:
     errors: list[str] = []
     checked = 0
+    file_sizes: dict[str, int] = {}
 
     for entry in attention_files:
         checked += 1
@@ -334,32 +367,49 @@ def validate_attention_assets(output_dir: Path, attention_files: list[dict[str,
             errors.append(f"invalid_path_metadata:{entry}")
             continue
 
-        path = output_dir / rel_path
-        if not path.exists():
-            errors.append(f"missing_file:{rel_path}")
-            continue
+        if rel_path not in file_sizes:
+            path = output_dir / rel_path
+            if not path.exists():
+                errors.append(f"missing_file:{rel_path}")
+                continue
+            file_sizes[rel_path] = path.stat().st_size
 
         shape = entry.get("shape", [])
         if not isinstance(shape, list) or not shape:
             errors.append(f"invalid_shape_metadata:{rel_path}")
             continue
 
-        expected_items = 1
-        for dim in shape:
-            if not isinstance(dim, int) or dim <= 0:
-                errors.append(f"invalid_shape_dimension:{rel_path}:{shape}")
-                expected_items = None
-                break
-            expected_items *= dim
+        if not all(isinstance(dim, int) and dim > 0 for dim in shape):
+            errors.append(f"invalid_shape_dimension:{rel_path}:{shape}")
+            continue
+
+        offset = entry.get("offset")
+        nbytes = entry.get("nbytes")
+        if not isinstance(offset, int) or offset < 0 or not isinstance(nbytes, int):
+            errors.append(f"invalid_offset_metadata:{rel_path}:{entry.get('layer_id')}:{entry.get('step')}")
+            continue
 
-        if expected_items is None:
+        dtype = ATTENTION_DTYPES.get(entry.get("dtype", "float16"))
+        if dtype is None:
+            errors.append(f"invalid_dtype_metadata:{rel_path}:{entry.get('dtype')}")
+            continue
+        itemsize = dtype.itemsize
+        if entry.get("dtype") == "uint8" and not valid_attention_scale(
+            entry.get("attention_type"), shape, entry.get("scale")
+        ):
+            errors.append(f"invalid_scale_metadata:{rel_path}:{entry.get('layer_id')}:{entry.get('step')}")
             continue
 
-        expected_bytes = expected_items * np.dtype(np.float16).itemsize
-        actual_bytes = path.stat().st_size
-        if actual_bytes != expected_bytes:
+        expected_bytes = int(np.prod(shape, dtype=np.int64)) * itemsize
+        if nbytes != expected_bytes:
             errors.append(
-                f"size_mismatch:{rel_path}:expected={expected_bytes}:actual={actual_bytes}"
+                f"size_mismatch:{rel_path}@{offset}:expected={expected_bytes}:actual={nbytes}"
+            )
+            continue
+
+        if offset + nbytes > file_sizes[rel_path]:
+            errors.append(
+                f"out_of_bounds:{rel_path}@{offset}:nbytes={nbytes}:file_size={file_sizes[rel_path]}"
             )
 
     return {
@@ -372,7 +422,7 @@ def validate_attention_assets(output_dir: Path, attention_files: list[dict[str,
 def main() -> None:
     args = parse_args()
     save_latents_noise = args.save_latents_noise
-    progress_file = Path(args.progress_file) if args.progress_file else None
+    progress = ProgressWriter(Path(args.progress_file) if args.progress_file else None)
 
     if args.num_steps <= 0:
         raise ValueError("--num-steps must be greater than 0")
@@ -395,8 +445,7 @@ def main() -> None:
 
     output_dir = Path(args.output_dir)
     prepare_output_dir(output_dir, overwrite_output=args.overwrite_output)
-    write_progress(
-        progress_file=progress_file,
+    progress.write(
         stage="initializing",
         message="Preparing diffusion pipeline...",
     )
@@ -410,8 +459,7 @@ def main() -> None:
     )
     pipe = pipe.to(device)
     pipe.set_progress_bar_config(disable=True)
-    write_progress(
-        progress_file=progress_file,
+    progress.write(
         stage="loading",
         message="Pipeline loaded. Encoding prompt...",
     )
@@ -445,6 +493,8 @@ def main() -> None:
         attention_resolution=args.attention_resolution,
         self_attention_resolution=args.self_attention_resolution,
         cfg_enabled=do_cfg,
+        attention_dtype=args.attention_dtype,
+        compile_reductions=args.compile_unet,
     )
 
     processor_map, selected_layers = create_recording_processors(
@@ -457,11 +507,13 @@ def main() -> None:
     )
     pipe.unet.set_attn_processor(processor_map)
 
+    # Default mode rather than "reduce-overhead": CUDA graph replay would skip the recording hooks.
+    unet = torch.compile(pipe.unet, fullgraph=False) if args.compile_unet else pipe.unet
+
     pipe.scheduler.set_timesteps(args.num_steps, device=device)
     timesteps = pipe.scheduler.timesteps
     total_steps = len(timesteps)
-    write_progress(
-        progress_file=progress_file,
+    progress.write(
         stage="generating",
         message="Starting diffusion timesteps...",
         current_step=0,
@@ -477,19 +529,45 @@ def main() -> None:
     generator = torch.Generator(device=device).manual_seed(args.seed)
     latents = torch.randn(latent_shape, generator=generator, device=device, dtype=dtype)
     latents = latents * pipe.scheduler.init_noise_sigma
+    # Static [2, C, H, W] CFG input refilled in place each step instead of torch.cat.
+    cfg_input = torch.empty((2, *latent_shape[1:]), device=device, dtype=dtype) if do_cfg else None
 
     serializer = DatasetSerializer(output_dir)
 
-    latent_history: list[np.ndarray] = []
-    noise_history: list[np.ndarray] = []
-
-    latent_norms: list[float] = []
-    noise_norms: list[float] = []
-    cosine_to_previous: list[float | None] = []
+    # Histories are written row by row; when exported they stream straight into a safetensors file.
+    history_shape = (total_steps, *latent_shape[1:])
+    noise_history: np.ndarray | None = None
+    if save_latents_noise:
+        histories = open_safetensors_memmap(
+            output_dir / "latents_noise_fp16.safetensors",
+            {
+                "latents": (history_shape, np.float16),
+                "predicted_noise": (history_shape, np.float16),
+            },
+        )
+        latent_history = histories["latents"]
+        noise_history = histories["predicted_noise"]
+    else:
+        latent_history = np.empty(history_shape, dtype=np.float16)
+
+    # Per-step scalars accumulate on device and are copied back once after the loop.
+    latent_norms_device = torch.zeros(total_steps, dtype=torch.float32, device=device)
+    noise_norms_device = torch.zeros(total_steps, dtype=torch.float32, device=device)
+    cosine_device = torch.zeros(total_steps, dtype=torch.float32, device=device)
+    prev_latents: torch.Tensor | None = None
+
+    # Pinned staging buffers let the fp16 D2H copies overlap with the scheduler step.
+    pin_host = device.type == "cuda"
+    latent_host = torch.empty(latent_shape[1:], dtype=torch.float16, pin_memory=pin_host)
+    noise_host = (
+        torch.empty(latent_shape[1:], dtype=torch.float16, pin_memory=pin_host)
+        if noise_history is not None
+        else None
+    )
 
     cross_entropy_steps: list[dict[str, Any]] = []
     self_entropy_steps: list[dict[str, Any]] = []
-    mean_token_activation_steps: list[list[float]] = []
+    token_activation_matrix = np.zeros((total_steps, len(tokens)), dtype=np.float32)
     shape_errors: list[str] = []
 
     print(f"Generating {len(timesteps)} timesteps...")
@@ -497,7 +575,10 @@ def main() -> None:
         timestep_int = to_timestep_int(timestep)
         recorder.set_step(step_index, timestep_int)
 
-        latent_model_input = torch.cat([latents] * 2) if do_cfg else latents
+        latent_model_input = latents
+        if cfg_input is not None:
+            cfg_input.copy_(latents.expand_as(cfg_input))
+            latent_model_input = cfg_input
         latent_model_input = pipe.scheduler.scale_model_input(latent_model_input, timestep)
 
         unet_kwargs: dict[str, Any] = {
@@ -508,7 +589,7 @@ def main() -> None:
             unet_kwargs["added_cond_kwargs"] = added_cond_kwargs
 
         with torch.no_grad():
-            noise_pred = pipe.unet(
+            noise_pred = unet(
                 latent_model_input,
                 timestep,
                 **unet_kwargs,
@@ -518,37 +599,45 @@ def main() -> None:
             noise_uncond, noise_text = noise_pred.chunk(2)
             noise_pred = noise_uncond + args.cfg_scale * (noise_text - noise_uncond)
 
-        noise_cpu = noise_pred.detach().float().cpu().numpy()[0]
-        noise_history.append(noise_cpu.astype(np.float16))
-        noise_norms.append(float(np.linalg.norm(noise_cpu.reshape(-1), ord=2)))
+        # Reduce on device and only move fp16 copies across.
+        noise_norms_device[step_index] = torch.linalg.vector_norm(noise_pred[0], dtype=torch.float32)
+        if noise_host is not None:
+            noise_host.copy_(noise_pred[0].detach().to(torch.float16), non_blocking=pin_host)
 
         latents = pipe.scheduler.step(noise_pred, timestep, latents, return_dict=False)[0]
 
-        latent_cpu = latents.detach().float().cpu().numpy()[0]
-        latent_history.append(latent_cpu.astype(np.float16))
-        latent_norms.append(latent_l2_norm(latent_cpu))
-
-        if len(latent_history) == 1:
-            cosine_to_previous.append(None)
-        else:
-            cosine_to_previous.append(
-                cosine_similarity(
-                    latent_history[-2].astype(np.float32),
-                    latent_history[-1].astype(np.float32),
-                )
-            )
+        latent_norms_device[step_index] = torch.linalg.vector_norm(latents[0], dtype=torch.float32)
+        latent_host.copy_(latents[0].detach().to(torch.float16), non_blocking=pin_host)
+        host_copy_done = torch.cuda.Event() if pin_host else None
+        if host_copy_done is not None:
+            host_copy_done.record()
+
+        if prev_latents is not None:
+            cosine_device[step_index] = F.cosine_similarity(
+                prev_latents.reshape(1, -1).float(),
+                latents.reshape(1, -1).float(),
+            )[0]
+        prev_latents = latents.detach()
 
         step_image = decode_latents_to_pil(pipe, latents)
+
+        if host_copy_done is not None:
+            host_copy_done.synchronize()
+        latent_history[step_index] = latent_host.numpy()
+        if noise_history is not None:
+            noise_history[step_index] = noise_host.numpy()
         serializer.save_image(step_index, step_image)
 
         step_data = recorder.drain_step()
         shape_errors.extend(step_data["shape_errors"])
 
-        for layer_id, cross_map in step_data["cross_maps"].items():
-            serializer.save_attention(step_index, layer_id, "cross", cross_map)
-
-        for layer_id, self_map in step_data["self_maps"].items():
-            serializer.save_attention(step_index, layer_id, "self", self_map)
+        serializer.save_attention_bundle(
+            step_index,
+            cross_maps=step_data["cross_maps"],
+            self_maps=step_data["self_maps"],
+            cross_scales=step_data["cross_map_scales"],
+            self_scales=step_data["self_map_scales"],
+        )
 
         cross_layer_entropy = step_data["cross_entropy"]
         self_layer_entropy = step_data["self_entropy"]
@@ -556,7 +645,7 @@ def main() -> None:
         cross_entropy_steps.append(
             {
                 "step": step_index,
-                "mean": float(np.mean(list(cross_layer_entropy.values())))
+                "mean": sum(cross_layer_entropy.values()) / len(cross_layer_entropy)
                 if cross_layer_entropy
                 else None,
                 "by_layer": cross_layer_entropy,
@@ -565,7 +654,7 @@ def main() -> None:
         self_entropy_steps.append(
             {
                 "step": step_index,
-                "mean": float(np.mean(list(self_layer_entropy.values())))
+                "mean": sum(self_layer_entropy.values()) / len(self_layer_entropy)
                 if self_layer_entropy
                 else None,
                 "by_layer": self_layer_entropy,
@@ -573,22 +662,30 @@ def main() -> None:
         )
 
         mean_token_activation = step_data["mean_token_activation"]
-        if mean_token_activation is None:
-            mean_token_activation = np.zeros((len(tokens),), dtype=np.float32)
-        mean_token_activation_steps.append(mean_token_activation.astype(np.float32).tolist())
+        if mean_token_activation is not None:
+            token_count = min(len(mean_token_activation), len(tokens))
+            token_activation_matrix[step_index, :token_count] = mean_token_activation[:token_count]
 
-        write_progress(
-            progress_file=progress_file,
+        progress.write(
             stage="generating",
             message=f"Completed step {step_index + 1} / {total_steps}",
             current_step=step_index + 1,
             total_steps=total_steps,
         )
 
-    pca_input = [x.astype(np.float32) for x in latent_history]
-    pca_result = compute_latent_pca(pca_input)
+    serializer.close()
+
+    latent_norms: list[float] = latent_norms_device.tolist()
+    noise_norms: list[float] = noise_norms_device.tolist()
+    cosine_to_previous: list[float | None] = [None, *cosine_device[1:].tolist()]
+
+    if noise_history is not None:
+        # PCA below reads the exported rows back through the same mapping, without a copy.
+        latent_history.flush()
+        noise_history.flush()
+
+    pca_result = compute_latent_pca(latent_history)
 
-    token_activation_matrix = np.array(mean_token_activation_steps, dtype=np.float32)
     mean_token_scores = token_activation_matrix.mean(axis=0)
 
     token_dominance = {
@@ -596,21 +693,7 @@ def main() -> None:
         "ranking": token_importance_ranking(mean_token_scores, top_k=min(25, len(tokens))),
     }
 
-    attention_kl_steps: list[float | None] = []
-    for i in range(len(token_activation_matrix)):
-        if i == 0:
-            attention_kl_steps.append(None)
-            continue
-        prev_dist = normalize_distribution(token_activation_matrix[i - 1])
-        curr_dist = normalize_distribution(token_activation_matrix[i])
-        attention_kl_steps.append(kl_divergence(curr_dist, prev_dist))
-
-    if save_latents_noise:
-        np.savez_compressed(
-            output_dir / "latents_noise_fp16.npz",
-            latents=np.stack(latent_history, axis=0),
-            predicted_noise=np.stack(noise_history, axis=0),
-        )
+    attention_kl_steps = stepwise_kl_divergence(token_activation_matrix)
 
     metadata = {
         "schema_version": "1.0.0",
@@ -628,8 +711,10 @@ def main() -> None:
             "include_self_attention": args.include_self_attention,
             "attention_resolution": args.attention_resolution,
             "self_attention_resolution": args.self_attention_resolution,
+            "attention_dtype": args.attention_dtype,
             "dtype": args.dtype,
             "device": str(device),
+            "compile_unet": args.compile_unet,
         },
         "prompt": {
             "text": args.prompt,
@@ -653,7 +738,7 @@ def main() -> None:
         "artifacts": {
             "metrics": "metrics.json",
             "latent_pca": "latent_pca.json",
-            "latents_noise": "latents_noise_fp16.npz" if save_latents_noise else None,
+            "latents_noise": "latents_noise_fp16.safetensors" if save_latents_noise else None,
         },
     }
 
@@ -663,7 +748,7 @@ def main() -> None:
         "cosine_similarity_to_previous": cosine_to_previous,
         "cross_attention_entropy": cross_entropy_steps,
         "self_attention_entropy": self_entropy_steps,
-        "mean_token_activation": mean_token_activation_steps,
+        "mean_token_activation": token_activation_matrix,
         "attention_kl_divergence": attention_kl_steps,
         "token_dominance": token_dominance,
         "shape_validation": {
@@ -677,8 +762,7 @@ def main() -> None:
         "explained_variance_ratio": pca_result.explained_variance_ratio,
     }
 
-    write_progress(
-        progress_file=progress_file,
+    progress.write(
         stage="exporting",
         message="Writing exported dataset to disk...",
         current_step=total_steps,
@@ -686,7 +770,8 @@ def main() -> None:
     )
 
     serializer.write_json("metadata.json", metadata)
-    serializer.write_json("metrics.json", metrics)
+    # metrics.json carries the per-step token arrays; skip pretty-printing for the largest file.
+    serializer.write_json("metrics.json", metrics, indent=False)
     serializer.write_json("latent_pca.json", latent_pca)
 
     attention_asset_validation = validate_attention_assets(
@@ -725,8 +810,7 @@ def main() -> None:
     if args.fail_on_shape_error and not attention_asset_validation["passed"]:
         raise RuntimeError("Attention asset validation failed.")
 
-    write_progress(
-        progress_file=progress_file,
+    progress.write(
         stage="completed",
         message="Generation finished successfully.",
         current_step=total_steps,
@@ -2,12 +2,59 @@ from __future__ import annotations
 
 import fnmatch
 import math
+import re
+import warnings
 from dataclasses import dataclass
 from typing import Dict, List
 
 import numpy as np
 import torch
 import torch.nn.functional as F
+from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+# Upper bound on [heads, query_tile, key] probability elements materialized at once while recording.
+PROB_TILE_ELEMENTS = 1 << 24
+
+
+def _attention_entropy(matrix: torch.Tensor) -> torch.Tensor:
+    # entr(p) = -p * log(p) in one elementwise kernel, with entr(0) = 0 (no fp16 clamp underflow).
+    return torch.special.entr(matrix).sum(dim=-1, dtype=torch.float32).mean()
+
+
+def _cross_reductions(matrix: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    return _attention_entropy(matrix), matrix.mean(dim=0, dtype=torch.float32)
+
+
+def _self_reductions(matrix: torch.Tensor, resolution: int) -> tuple[torch.Tensor, torch.Tensor]:
+    pooled = F.adaptive_avg_pool2d(matrix[None, None], (resolution, resolution))[0, 0]
+    return _attention_entropy(matrix), pooled.to(dtype=torch.float16)
+
+
+def _compile_with_fallback(fn):
+    # Dynamo internals are only needed on the compile path, so import them there.
+    from torch._dynamo.exc import BackendCompilerFailed
+
+    compiled = torch.compile(fn, dynamic=True)
+
+    def run(*args):
+        nonlocal compiled
+        if compiled is fn:
+            return fn(*args)
+        try:
+            return compiled(*args)
+        except BackendCompilerFailed as exc:
+            # Only compiler backend failures fall back; OOMs and genuine errors still propagate.
+            detail = str(exc).strip().splitlines()
+            warnings.warn(
+                f"torch.compile failed for {fn.__name__} ({type(exc).__name__}"
+                f"{': ' + detail[0] if detail else ''}); running it eagerly from now on.",
+                RuntimeWarning,
+                stacklevel=2,
+            )
+            compiled = fn
+            return fn(*args)
+
+    return run
 
 
 @dataclass
@@ -24,89 +71,147 @@ class AttentionRecorder:
         attention_resolution: int,
         self_attention_resolution: int,
         cfg_enabled: bool,
+        attention_dtype: str = "float16",
+        compile_reductions: bool = False,
     ) -> None:
         if token_count <= 0:
             raise ValueError("token_count must be > 0")
         if attention_resolution <= 0 or self_attention_resolution <= 0:
             raise ValueError("attention resolutions must be > 0")
+        if attention_dtype not in {"float16", "uint8"}:
+            raise ValueError(f"Unsupported attention dtype: {attention_dtype}")
 
         self.token_count = token_count
         self.attention_resolution = attention_resolution
         self.self_attention_resolution = self_attention_resolution
         self.cfg_enabled = cfg_enabled
+        self.attention_dtype = attention_dtype
+
+        self._cross_reductions = _cross_reductions
+        self._self_reductions = _self_reductions
+        if compile_reductions:
+            self._cross_reductions = _compile_with_fallback(_cross_reductions)
+            self._self_reductions = _compile_with_fallback(_self_reductions)
 
         self.current_step = -1
         self.current_timestep = -1
-        self._cross_maps: dict[str, np.ndarray] = {}
-        self._self_maps: dict[str, np.ndarray] = {}
-        self._cross_entropy: dict[str, float] = {}
-        self._self_entropy: dict[str, float] = {}
-        self._token_activation_by_layer: dict[str, np.ndarray] = {}
+        # Maps and reductions stay on device until drain_step copies them back in one go.
+        # Cross maps are kept as raw [query, key] matrices and downsampled in batches at drain time.
+        self._pending_cross: dict[str, torch.Tensor] = {}
+        # Entropies, token activations and self maps are written into slot-indexed device buffers
+        # (one row per registered layer); the recorded lists keep this step's (layer_id, slot) order.
+        self._slots: dict[str, dict[str, int]] = {"cross": {}, "self": {}}
+        self._slot_buffers: dict[str, torch.Tensor] = {}
+        self._cross_recorded: list[tuple[str, int]] = []
+        self._self_recorded: list[tuple[str, int]] = []
         self.shape_errors: list[str] = []
 
+        # Reused pinned staging buffers for drain_step's device-to-host copies (CUDA only).
+        self._host_buffers: dict[str, torch.Tensor] = {}
+        self._host_copies_pending = False
+        self._cross_out: torch.Tensor | None = None
+
     def set_step(self, step: int, timestep: int) -> None:
         self.current_step = step
         self.current_timestep = timestep
-        self._cross_maps.clear()
-        self._self_maps.clear()
-        self._cross_entropy.clear()
-        self._self_entropy.clear()
-        self._token_activation_by_layer.clear()
-
-    def _extract_conditional_attention(
-        self, attention_probs: torch.Tensor, heads: int
-    ) -> torch.Tensor | None:
-        if attention_probs.ndim != 3:
-            self.shape_errors.append(
-                f"step={self.current_step} has invalid attention rank {attention_probs.ndim}"
-            )
-            return None
-
-        if heads <= 0:
-            self.shape_errors.append(
-                f"step={self.current_step} has invalid head count {heads}"
-            )
-            return None
-
-        batch_heads, query_tokens, key_tokens = attention_probs.shape
-        if batch_heads % heads != 0:
-            self.shape_errors.append(
-                f"step={self.current_step} cannot reshape attention {list(attention_probs.shape)} with heads={heads}"
-            )
-            return None
-
-        batch = batch_heads // heads
-        reshaped = attention_probs.reshape(batch, heads, query_tokens, key_tokens)
-        cond_index = batch - 1 if self.cfg_enabled and batch > 1 else 0
-        return reshaped[cond_index].mean(dim=0)
+        self._pending_cross.clear()
+        self._cross_recorded.clear()
+        self._self_recorded.clear()
 
-    def _entropy(self, matrix: torch.Tensor) -> float:
-        p = matrix.clamp(min=1e-8)
-        entropy = -(p * p.log()).sum(dim=-1).mean()
-        return float(entropy.detach().cpu().item())
+    def register_layer(self, layer_id: str, attention_type: str) -> int:
+        slots = self._slots[attention_type]
+        return slots.setdefault(layer_id, len(slots))
 
-    def record(
+    def _slot_buffer(
+        self,
+        name: str,
+        attention_type: str,
+        slot: int,
+        tail: tuple[int, ...],
+        dtype: torch.dtype,
+        device: torch.device,
+    ) -> torch.Tensor:
+        rows = max(len(self._slots[attention_type]), slot + 1)
+        buffer = self._slot_buffers.get(name)
+        if buffer is None or buffer.shape[0] < rows or buffer.shape[1:] != tail or buffer.device != device:
+            grown = torch.zeros((rows, *tail), dtype=dtype, device=device)
+            if buffer is not None and buffer.shape[1:] == tail and buffer.device == device:
+                grown[: buffer.shape[0]] = buffer
+            buffer = grown
+            self._slot_buffers[name] = buffer
+        return buffer
+
+    def conditional_index(self, batch: int) -> int:
+        return batch - 1 if self.cfg_enabled and batch > 1 else 0
+
+    @staticmethod
+    def _quantize_uint8(maps: torch.Tensor, scale_dims: int = 1) -> tuple[torch.Tensor, torch.Tensor]:
+        # One linear scale per slice over the leading scale_dims (value = q * scale): self-attention
+        # maps are far below 1, and a shared scale would band the weaker content tokens of a cross map.
+        flat = maps.flatten(start_dim=scale_dims).float()
+        scales = flat.amax(dim=-1).clamp_min(1e-12) / 255.0
+        quantized = (flat / scales.unsqueeze(-1)).round_().clamp_(0, 255).to(torch.uint8)
+        return quantized.reshape(maps.shape), scales
+
+    def _stage_to_host(self, name: str, tensor: torch.Tensor) -> torch.Tensor:
+        on_cuda = tensor.device.type == "cuda"
+        buffer = self._host_buffers.get(name)
+        if buffer is None or buffer.shape != tensor.shape or buffer.dtype != tensor.dtype:
+            buffer = torch.empty(tensor.shape, dtype=tensor.dtype, pin_memory=on_cuda)
+            self._host_buffers[name] = buffer
+        # Always copy, even on CPU: the device tensors are the recording buffers and get
+        # overwritten by the next step.
+        buffer.copy_(tensor, non_blocking=on_cuda)
+        self._host_copies_pending = self._host_copies_pending or on_cuda
+        return buffer
+
+    def _wait_for_host_copies(self) -> None:
+        if self._host_copies_pending:
+            torch.cuda.current_stream().synchronize()
+            self._host_copies_pending = False
+
+    def record_head_mean(
         self,
         layer_id: str,
         attention_type: str,
-        attention_probs: torch.Tensor,
-        heads: int,
+        matrix: torch.Tensor,
+        slot: int | None = None,
     ) -> None:
+        # matrix: head-averaged [query_tokens, key_tokens] probabilities of the conditional batch entry.
         with torch.no_grad():
             if attention_type not in {"cross", "self"}:
                 self.shape_errors.append(
                     f"step={self.current_step} layer={layer_id} has unsupported attention type '{attention_type}'"
                 )
                 return
-
-            matrix = self._extract_conditional_attention(attention_probs, heads)
-            if matrix is None:
+            if matrix.ndim != 2:
+                self.shape_errors.append(
+                    f"step={self.current_step} layer={layer_id} has invalid attention rank {matrix.ndim}"
+                )
                 return
 
+            if slot is None:
+                slot = self.register_layer(layer_id, attention_type)
+            device = matrix.device
+
             if attention_type == "cross":
-                self._cross_entropy[layer_id] = self._entropy(matrix)
-                token_activation = matrix.mean(dim=0).detach().float().cpu().numpy()
-                self._token_activation_by_layer[layer_id] = token_activation
+                key_tokens = matrix.shape[1]
+                activations = self._slot_buffers.get("token_activation")
+                if self._cross_recorded and activations is not None and activations.shape[1] != key_tokens:
+                    self.shape_errors.append(
+                        f"step={self.current_step} layer={layer_id} key_tokens={key_tokens} "
+                        f"differs from other cross layers ({activations.shape[1]})"
+                    )
+                    return
+
+                entropy, activation = self._cross_reductions(matrix)
+                entropies = self._slot_buffer("cross_entropy", "cross", slot, (), torch.float32, device)
+                entropies[slot] = entropy
+                activations = self._slot_buffer(
+                    "token_activation", "cross", slot, (key_tokens,), torch.float32, device
+                )
+                activations[slot] = activation
+                self._cross_recorded.append((layer_id, slot))
 
                 query_tokens = matrix.shape[0]
                 side = int(math.sqrt(query_tokens))
@@ -116,65 +221,183 @@ class AttentionRecorder:
                     )
                     return
 
-                token_maps = matrix.transpose(0, 1).reshape(
-                    matrix.shape[1], side, side
-                )
-                token_maps = token_maps.unsqueeze(0)
-                downsampled = F.interpolate(
-                    token_maps,
-                    size=(self.attention_resolution, self.attention_resolution),
-                    mode="bilinear",
-                    align_corners=False,
-                )[0]
-
-                if downsampled.shape[0] != self.token_count:
-                    min_tokens = min(downsampled.shape[0], self.token_count)
-                    fixed = torch.zeros(
-                        (self.token_count, self.attention_resolution, self.attention_resolution),
-                        dtype=downsampled.dtype,
-                        device=downsampled.device,
-                    )
-                    fixed[:min_tokens] = downsampled[:min_tokens]
-                    downsampled = fixed
-
-                self._cross_maps[layer_id] = (
-                    downsampled.detach().to(dtype=torch.float16).cpu().numpy()
-                )
+                self._pending_cross[layer_id] = matrix
                 return
 
-            self._self_entropy[layer_id] = self._entropy(matrix)
-            pooled = F.adaptive_avg_pool2d(
-                matrix.unsqueeze(0).unsqueeze(0),
-                (self.self_attention_resolution, self.self_attention_resolution),
-            )[0, 0]
-            self._self_maps[layer_id] = pooled.detach().to(dtype=torch.float16).cpu().numpy()
+            entropy, pooled = self._self_reductions(matrix, self.self_attention_resolution)
+            entropies = self._slot_buffer("self_entropy", "self", slot, (), torch.float32, device)
+            entropies[slot] = entropy
+            maps = self._slot_buffer("self_maps", "self", slot, tuple(pooled.shape), torch.float16, device)
+            maps[slot] = pooled
+            self._self_recorded.append((layer_id, slot))
+
+    def _cross_out_buffer(self, layer_count: int, device: torch.device) -> torch.Tensor:
+        # One fp16 output tensor reused every step; padded token rows are zeroed in place.
+        resolution = self.attention_resolution
+        shape = (layer_count, self.token_count, resolution, resolution)
+        buffer = self._cross_out
+        if buffer is None or buffer.shape != shape or buffer.device != device:
+            buffer = torch.empty(shape, dtype=torch.float16, device=device)
+            self._cross_out = buffer
+        return buffer
+
+    def _downsample_cross_maps(self) -> tuple[list[str], torch.Tensor | None]:
+        if not self._pending_cross:
+            return [], None
+
+        # Layers at the same spatial resolution share one interpolate call.
+        buckets: dict[tuple[int, ...], list[str]] = {}
+        for layer_id, matrix in self._pending_cross.items():
+            buckets.setdefault(tuple(matrix.shape), []).append(layer_id)
+
+        resolution = self.attention_resolution
+        first = next(iter(self._pending_cross.values()))
+        out = self._cross_out_buffer(len(self._pending_cross), first.device)
+        layer_order: list[str] = []
+        row = 0
+        for (query_tokens, key_tokens), layer_ids in buckets.items():
+            side = math.isqrt(query_tokens)
+            stacked = torch.stack([self._pending_cross[layer_id] for layer_id in layer_ids], dim=0)
+            token_maps = stacked.transpose(1, 2).reshape(len(layer_ids), key_tokens, side, side)
+            downsampled = F.interpolate(
+                token_maps,
+                size=(resolution, resolution),
+                mode="bilinear",
+                align_corners=False,
+            )
+
+            target = out[row : row + len(layer_ids)]
+            min_tokens = min(key_tokens, self.token_count)
+            target[:, :min_tokens].copy_(downsampled[:, :min_tokens])
+            if min_tokens < self.token_count:
+                target[:, min_tokens:].zero_()
+
+            layer_order.extend(layer_ids)
+            row += len(layer_ids)
+
+        return layer_order, out
 
     def drain_step(self) -> dict:
+        # Queue every copy first, then wait once. Returned maps are views into the staging
+        # buffers on every device and stay valid until the next drain_step.
+        quantize = self.attention_dtype == "uint8"
+        cross_order, cross_device = self._downsample_cross_maps()
+        cross_host = cross_scales_host = None
+        if cross_device is not None:
+            if quantize:
+                cross_device, cross_scales = self._quantize_uint8(cross_device, scale_dims=2)
+                cross_scales_host = self._stage_to_host("cross_scales", cross_scales)
+            cross_host = self._stage_to_host("cross_maps", cross_device)
+        self_host = self_scales_host = None
+        if self._self_recorded:
+            self_device = self._slot_buffers["self_maps"]
+            if quantize:
+                self_device, self_scales = self._quantize_uint8(self_device)
+                self_scales_host = self._stage_to_host("self_scales", self_scales)
+            self_host = self._stage_to_host("self_maps", self_device)
+
+        activation_host = cross_entropy_host = None
+        if self._cross_recorded:
+            activations = self._slot_buffers["token_activation"]
+            filled = sorted({slot for _, slot in self._cross_recorded})
+            if len(filled) < activations.shape[0]:
+                activations = activations[filled]
+            activation_host = self._stage_to_host("token_activation", activations.mean(dim=0))
+            cross_entropy_host = self._stage_to_host("cross_entropy", self._slot_buffers["cross_entropy"])
+        self_entropy_host = None
+        if self._self_recorded:
+            self_entropy_host = self._stage_to_host("self_entropy", self._slot_buffers["self_entropy"])
+
+        self._wait_for_host_copies()
+
+        cross_maps: dict[str, np.ndarray] = {}
+        cross_map_scales: dict[str, list[float]] = {}
+        if cross_host is not None:
+            by_layer = dict(zip(cross_order, cross_host.numpy()))
+            cross_maps = {layer_id: by_layer[layer_id] for layer_id in self._pending_cross}
+            if cross_scales_host is not None:
+                cross_map_scales = dict(zip(cross_order, cross_scales_host.tolist()))
+        self_maps: dict[str, np.ndarray] = {}
+        self_map_scales: dict[str, float] = {}
+        if self_host is not None:
+            self_rows = self_host.numpy()
+            self_maps = {layer_id: self_rows[slot] for layer_id, slot in self._self_recorded}
+            if self_scales_host is not None:
+                scales = self_scales_host.tolist()
+                self_map_scales = {layer_id: scales[slot] for layer_id, slot in self._self_recorded}
+
         mean_token_activation = None
-        if self._token_activation_by_layer:
-            stacked = np.stack(list(self._token_activation_by_layer.values()), axis=0)
-            mean_token_activation = stacked.mean(axis=0).astype(np.float32)
+        if activation_host is not None:
+            mean_token_activation = activation_host.numpy().copy()
+
+        cross_entropy: dict[str, float] = {}
+        if cross_entropy_host is not None:
+            values = cross_entropy_host.tolist()
+            cross_entropy = {layer_id: values[slot] for layer_id, slot in self._cross_recorded}
+        self_entropy: dict[str, float] = {}
+        if self_entropy_host is not None:
+            values = self_entropy_host.tolist()
+            self_entropy = {layer_id: values[slot] for layer_id, slot in self._self_recorded}
 
         output = {
             "step": self.current_step,
             "timestep": self.current_timestep,
-            "cross_maps": dict(self._cross_maps),
-            "self_maps": dict(self._self_maps),
-            "cross_entropy": dict(self._cross_entropy),
-            "self_entropy": dict(self._self_entropy),
+            "cross_maps": cross_maps,
+            "self_maps": self_maps,
+            "cross_map_scales": cross_map_scales,
+            "self_map_scales": self_map_scales,
+            "cross_entropy": cross_entropy,
+            "self_entropy": self_entropy,
             "mean_token_activation": mean_token_activation,
-            "shape_errors": list(self.shape_errors),
+            "shape_errors": self.shape_errors,
         }
-        self.shape_errors.clear()
+        # Rebind rather than copy-and-clear; this also releases the raw cross matrices right away.
+        self.shape_errors = []
+        self._pending_cross = {}
+        self._cross_recorded = []
+        self._self_recorded = []
         return output
 
 
 class RecordingAttnProcessor:
-    def __init__(self, recorder: AttentionRecorder, layer_id: str, attention_type: str) -> None:
+    def __init__(
+        self,
+        recorder: AttentionRecorder,
+        layer_id: str,
+        attention_type: str,
+        slot: int | None = None,
+    ) -> None:
         self.recorder = recorder
         self.layer_id = layer_id
         self.attention_type = attention_type
+        self.slot = slot
+        self._bound_attn = None
+        self._attn_consts: tuple = ()
+
+    def _bind(self, attn) -> tuple:
+        # Each processor serves one Attention module; resolve its attributes once.
+        self._bound_attn = attn
+        self._attn_consts = (
+            attn.spatial_norm,
+            attn.group_norm,
+            attn.norm_cross,
+            attn.heads,
+            attn.scale,
+            attn.to_q,
+            attn.to_k,
+            attn.to_v,
+            attn.to_out[0],
+            attn.to_out[1],
+            attn.residual_connection,
+            attn.rescale_output_factor,
+            attn.prepare_attention_mask,
+            attn.get_attention_scores,
+            attn.head_to_batch_dim,
+        )
+        return self._attn_consts
 
+    # Recording does host-side bookkeeping every call, so it always runs eagerly under torch.compile.
+    @torch.compiler.disable
     def __call__(
         self,
         attn,
@@ -185,10 +408,28 @@ class RecordingAttnProcessor:
         *args,
         **kwargs,
     ):
+        (
+            spatial_norm,
+            group_norm,
+            norm_cross,
+            heads,
+            scale,
+            to_q,
+            to_k,
+            to_v,
+            to_out_proj,
+            to_out_dropout,
+            residual_connection,
+            rescale_output_factor,
+            prepare_attention_mask,
+            get_attention_scores,
+            head_to_batch_dim,
+        ) = self._attn_consts if attn is self._bound_attn else self._bind(attn)
+
         residual = hidden_states
 
-        if attn.spatial_norm is not None:
-            hidden_states = attn.spatial_norm(hidden_states, temb)
+        if spatial_norm is not None:
+            hidden_states = spatial_norm(hidden_states, temb)
 
         input_ndim = hidden_states.ndim
         if input_ndim == 4:
@@ -200,55 +441,80 @@ class RecordingAttnProcessor:
             if encoder_hidden_states is None
             else encoder_hidden_states.shape
         )
-        attention_mask = attn.prepare_attention_mask(attention_mask, sequence_length, batch_size)
+        attention_mask = prepare_attention_mask(attention_mask, sequence_length, batch_size)
 
-        if attn.group_norm is not None:
-            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+        if group_norm is not None:
+            hidden_states = group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
 
-        query = attn.to_q(hidden_states)
+        query = to_q(hidden_states)
 
         if encoder_hidden_states is None:
             encoder_hidden_states = hidden_states
-        elif attn.norm_cross:
+        elif norm_cross:
             encoder_hidden_states = attn.norm_encoder_hidden_states(encoder_hidden_states)
 
-        key = attn.to_k(encoder_hidden_states)
-        value = attn.to_v(encoder_hidden_states)
-
-        query = attn.head_to_batch_dim(query)
-        key = attn.head_to_batch_dim(key)
-        value = attn.head_to_batch_dim(value)
-
-        attention_probs = attn.get_attention_scores(query, key, attention_mask)
-        self.recorder.record(
-            layer_id=self.layer_id,
-            attention_type=self.attention_type,
-            attention_probs=attention_probs.detach(),
-            heads=attn.heads,
+        key = to_k(encoder_hidden_states)
+        value = to_v(encoder_hidden_states)
+
+        # Probabilities are only materialized for the batch entry that gets recorded, and in
+        # query tiles, so only the head-averaged [Q, K] map is ever held in full.
+        cond_index = self.recorder.conditional_index(batch_size)
+        cond_mask = None
+        if attention_mask is not None:
+            cond_mask = attention_mask[cond_index * heads : (cond_index + 1) * heads]
+        cond_query = query[cond_index : cond_index + 1]
+        cond_key = head_to_batch_dim(key[cond_index : cond_index + 1])
+        query_tokens = cond_query.shape[1]
+        key_tokens = cond_key.shape[1]
+        tile = max(1, PROB_TILE_ELEMENTS // (heads * key_tokens))
+        # Recording never needs gradients, so the tiles are built without autograd views or graph.
+        with torch.no_grad():
+            mean_probs = query.new_empty((query_tokens, key_tokens))
+            for start in range(0, query_tokens, tile):
+                stop = min(start + tile, query_tokens)
+                tile_mask = cond_mask
+                if cond_mask is not None and cond_mask.shape[1] != 1:
+                    tile_mask = cond_mask[:, start:stop]
+                tile_probs = get_attention_scores(
+                    head_to_batch_dim(cond_query[:, start:stop]), cond_key, tile_mask
+                )
+                torch.mean(tile_probs, dim=0, out=mean_probs[start:stop])
+            self.recorder.record_head_mean(self.layer_id, self.attention_type, mean_probs, self.slot)
+
+        # The layer output itself goes through the fused SDPA kernel.
+        head_dim = key.shape[-1] // heads
+        query = query.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, heads, head_dim).transpose(1, 2)
+        if attention_mask is not None:
+            attention_mask = attention_mask.view(batch_size, heads, -1, attention_mask.shape[-1])
+
+        hidden_states = F.scaled_dot_product_attention(
+            query, key, value, attn_mask=attention_mask, dropout_p=0.0, is_causal=False, scale=scale
         )
+        hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, heads * head_dim)
+        hidden_states = hidden_states.to(query.dtype)
 
-        hidden_states = torch.bmm(attention_probs, value)
-        hidden_states = attn.batch_to_head_dim(hidden_states)
-
-        hidden_states = attn.to_out[0](hidden_states)
-        hidden_states = attn.to_out[1](hidden_states)
+        hidden_states = to_out_proj(hidden_states)
+        hidden_states = to_out_dropout(hidden_states)
 
         if input_ndim == 4:
             hidden_states = hidden_states.transpose(-1, -2).reshape(
                 batch_size, channel, height, width
             )
 
-        if attn.residual_connection:
+        if residual_connection:
             hidden_states = hidden_states + residual
 
-        hidden_states = hidden_states / attn.rescale_output_factor
+        hidden_states = hidden_states / rescale_output_factor
         return hidden_states
 
 
-def _matches_any_pattern(value: str, patterns: List[str]) -> bool:
+def _compile_patterns(patterns: List[str]) -> re.Pattern | None:
+    # One regex alternation over the translated globs, matched once per processor key.
     if not patterns:
-        return True
-    return any(fnmatch.fnmatch(value, pattern) for pattern in patterns)
+        return None
+    return re.compile("|".join(fnmatch.translate(pattern) for pattern in patterns))
 
 
 def create_recording_processors(
@@ -262,21 +528,26 @@ def create_recording_processors(
     processor_map: Dict[str, object] = {}
     selected_layers: List[LayerInfo] = []
 
+    compiled_patterns = _compile_patterns(layer_patterns)
     ordered_items = list(unet.attn_processors.items())
     for key, original in ordered_items:
         is_cross = ".attn2." in key
         is_self = ".attn1." in key
 
         keep_kind = (is_cross and include_cross_attention) or (is_self and include_self_attention)
-        matches = _matches_any_pattern(key, layer_patterns)
+        matches = compiled_patterns is None or compiled_patterns.match(key) is not None
 
         if keep_kind and matches and (max_layers <= 0 or len(selected_layers) < max_layers):
             layer_id = f"layer_{len(selected_layers)}"
             attention_type = "cross" if is_cross else "self"
-            processor_map[key] = RecordingAttnProcessor(recorder, layer_id, attention_type)
+            slot = recorder.register_layer(layer_id, attention_type)
+            processor_map[key] = RecordingAttnProcessor(recorder, layer_id, attention_type, slot)
             selected_layers.append(
                 LayerInfo(layer_id=layer_id, processor_key=key, attention_type=attention_type)
             )
+        elif type(original) is AttnProcessor:
+            # Unrecorded layers should use the fused SDPA kernel rather than the eager fallback.
+            processor_map[key] = AttnProcessor2_0()
         else:
             processor_map[key] = original
 
@@ -1,12 +1,13 @@
 from __future__ import annotations
 
 import json
+import os
 import re
 import subprocess
 import sys
 import threading
-import time
 import uuid
+from collections import deque
 from dataclasses import dataclass, field
 from datetime import datetime, timezone
 from pathlib import Path
@@ -17,12 +18,18 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, Field
 
+try:
+    import orjson
+except ImportError:  # orjson is optional; fall back to the stdlib decoder.
+    orjson = None
+
 
 BASE_DIR = Path(__file__).resolve().parent
 DATASET_ROOT = BASE_DIR / "dataset"
 PROGRESS_ROOT = BASE_DIR / "outputs" / "runtime_progress"
 DATASET_ROOT.mkdir(parents=True, exist_ok=True)
 PROGRESS_ROOT.mkdir(parents=True, exist_ok=True)
+LOG_TAIL_LINES = 2000
 
 
 def utc_now_iso() -> str:
@@ -102,22 +109,62 @@ def _update_job(job_id: str, **kwargs: Any) -> None:
 
 
 def _read_progress(progress_file: Path) -> dict[str, Any] | None:
-    if not progress_file.exists():
-        return None
     try:
-        return json.loads(progress_file.read_text(encoding="utf-8"))
+        raw = progress_file.read_bytes()
+        # orjson.JSONDecodeError subclasses json.JSONDecodeError, so one except covers both.
+        return orjson.loads(raw) if orjson is not None else json.loads(raw)
     except (OSError, json.JSONDecodeError):
         return None
 
 
+def _progress_signature(progress_file: Path) -> tuple[int, int, int] | None:
+    try:
+        stat = os.stat(progress_file)
+    except OSError:
+        return None
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+
+def _drain_pipe(pipe, lines: deque[str]) -> None:
+    with pipe:
+        for line in pipe:
+            lines.append(line)
+
+
 def _monitor_job(job_id: str, process: subprocess.Popen[str], progress_file: Path, output_name: str) -> None:
-    while process.poll() is None:
+    # Pipes are drained continuously so a chatty child can never block on a full buffer.
+    stdout_lines: deque[str] = deque(maxlen=LOG_TAIL_LINES)
+    stderr_lines: deque[str] = deque(maxlen=LOG_TAIL_LINES)
+    readers = [
+        threading.Thread(target=_drain_pipe, args=(process.stdout, stdout_lines), daemon=True),
+        threading.Thread(target=_drain_pipe, args=(process.stderr, stderr_lines), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+
+    last_signature = None
+    while True:
+        try:
+            process.wait(timeout=0.25)
+            break
+        except subprocess.TimeoutExpired:
+            pass
+
+        # Only re-parse the progress file when it has actually been rewritten.
+        signature = _progress_signature(progress_file)
+        if signature is None or signature == last_signature:
+            continue
         progress = _read_progress(progress_file)
-        if progress is not None:
-            _update_job(job_id, progress=progress)
-        time.sleep(0.75)
-
-    stdout, stderr = process.communicate()
+        if progress is None:
+            # Caught mid-write; retry on the next tick.
+            continue
+        last_signature = signature
+        _update_job(job_id, progress=progress)
+
+    for reader in readers:
+        reader.join()
+    stdout = "".join(stdout_lines)
+    stderr = "".join(stderr_lines)
     combined_logs = "\n".join([stdout.strip(), stderr.strip()]).strip()
     if len(combined_logs) > 10000:
         combined_logs = combined_logs[-10000:]
@@ -4,10 +4,10 @@ from dataclasses import dataclass
 from typing import Iterable, List
 
 import numpy as np
-from sklearn.decomposition import PCA
 
 
 EPS = 1e-8
+PCA_COLUMN_CHUNK = 8192
 
 
 def latent_l2_norm(latent: np.ndarray) -> float:
@@ -15,15 +15,20 @@ def latent_l2_norm(latent: np.ndarray) -> float:
 
 
 def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
-    a_flat = a.reshape(-1).astype(np.float64)
-    b_flat = b.reshape(-1).astype(np.float64)
-    denom = (np.linalg.norm(a_flat) * np.linalg.norm(b_flat)) + EPS
-    return float(np.dot(a_flat, b_flat) / denom)
+    # Stay in the latents' native float32: ravel is a view for contiguous input, and the
+    # three BLAS dots replace two norms plus a dot over float64 copies.
+    a_flat = np.ravel(a).astype(np.float32, copy=False)
+    b_flat = np.ravel(b).astype(np.float32, copy=False)
+    s_ab = float(np.dot(a_flat, b_flat))
+    s_aa = float(np.dot(a_flat, a_flat))
+    s_bb = float(np.dot(b_flat, b_flat))
+    return float(s_ab / (np.sqrt(s_aa * s_bb) + EPS))
 
 
 def shannon_entropy(probabilities: np.ndarray, axis: int = -1) -> np.ndarray:
-    p = np.clip(probabilities, EPS, 1.0)
-    return -np.sum(p * np.log(p), axis=axis)
+    p = np.moveaxis(np.clip(probabilities, EPS, 1.0), axis, -1)
+    # einsum fuses the p * log(p) product into the row reduction (no product temporary).
+    return -np.einsum("...k,...k->...", p, np.log(p))
 
 
 def mean_attention_entropy(attention_matrix: np.ndarray) -> float:
@@ -38,7 +43,15 @@ def mean_token_activation(attention_matrix: np.ndarray) -> np.ndarray:
 
 
 def token_importance_ranking(token_scores: np.ndarray, top_k: int = 20) -> list[dict]:
-    indices = np.argsort(token_scores)[::-1][:top_k]
+    token_scores = np.asarray(token_scores)
+    if top_k <= 0:
+        return []
+    if top_k >= token_scores.size:
+        indices = np.argsort(-token_scores)
+    else:
+        # Select the top_k in linear time, then order only those.
+        indices = np.argpartition(-token_scores, top_k - 1)[:top_k]
+        indices = indices[np.argsort(-token_scores[indices])]
     return [
         {
             "token_index": int(i),
@@ -54,26 +67,61 @@ class PcaResult:
     explained_variance_ratio: list[float]
 
 
-def compute_latent_pca(latents: Iterable[np.ndarray]) -> PcaResult:
-    latent_list: List[np.ndarray] = [x.reshape(-1).astype(np.float32) for x in latents]
+def compute_latent_pca(latents: np.ndarray | Iterable[np.ndarray]) -> PcaResult:
+    if not isinstance(latents, np.ndarray):
+        latent_list: List[np.ndarray] = [np.asarray(x).reshape(-1) for x in latents]
+        latents = np.stack(latent_list, axis=0) if latent_list else np.empty((0, 0), dtype=np.float32)
 
-    if len(latent_list) == 0:
+    if len(latents) == 0:
         return PcaResult(points=[], explained_variance_ratio=[0.0, 0.0])
 
-    stacked = np.stack(latent_list, axis=0)
-    if stacked.shape[0] == 1:
+    flat = latents.reshape(len(latents), -1)
+    steps = flat.shape[0]
+    if steps == 1:
         return PcaResult(points=[[0.0, 0.0]], explained_variance_ratio=[1.0, 0.0])
 
-    model = PCA(n_components=2)
-    transformed = model.fit_transform(stacked)
+    # steps << features, so PCA goes through the [steps, steps] Gram matrix of the centred
+    # latents. It is accumulated over column chunks in one pass; only a [steps, chunk]
+    # block is ever upcast.
+    gram = np.zeros((steps, steps), dtype=np.float64)
+    for start in range(0, flat.shape[1], PCA_COLUMN_CHUNK):
+        block = flat[:, start : start + PCA_COLUMN_CHUNK].astype(np.float64)
+        block -= block.mean(axis=0)
+        gram += block @ block.T
+
+    eigenvalues, eigenvectors = np.linalg.eigh(gram)
+    eigenvalues = np.clip(eigenvalues[::-1][:2], 0.0, None)
+    eigenvectors = eigenvectors[:, ::-1][:, :2]
+    # Deterministic sign: the largest-magnitude coordinate of each component is positive.
+    signs = np.sign(eigenvectors[np.abs(eigenvectors).argmax(axis=0), [0, 1]])
+    signs[signs == 0] = 1.0
+    points = eigenvectors * signs * np.sqrt(eigenvalues)
+
+    total_variance = float(np.trace(gram))
+    ratio = eigenvalues / total_variance if total_variance > 0 else np.zeros(2)
 
     return PcaResult(
-        points=transformed.astype(np.float32).tolist(),
-        explained_variance_ratio=model.explained_variance_ratio_.astype(np.float32).tolist(),
+        points=points.astype(np.float32).tolist(),
+        explained_variance_ratio=ratio.astype(np.float32).tolist(),
     )
 
 
 def kl_divergence(p: np.ndarray, q: np.ndarray) -> float:
-    p_safe = np.clip(p.astype(np.float64), EPS, 1.0)
-    q_safe = np.clip(q.astype(np.float64), EPS, 1.0)
-    return float(np.sum(p_safe * np.log(p_safe / q_safe)))
+    # Clip into buffers at the inputs' own precision (float32 arrays are not upcast), but take
+    # log p - log q in float64: float32 log rounding exceeds the KL of nearby distributions.
+    p = np.asarray(p)
+    q = np.asarray(q)
+    p_safe = np.clip(p, EPS, 1.0, dtype=np.result_type(p, np.float32)).ravel()
+    q_safe = np.clip(q, EPS, 1.0, dtype=np.result_type(q, np.float32)).ravel()
+    log_ratio = np.log(p_safe, dtype=np.float64)
+    log_ratio -= np.log(q_safe, dtype=np.float64)
+    return float(np.dot(p_safe, log_ratio))
+
+
+def stepwise_kl_divergence(values: np.ndarray) -> list[float | None]:
+    # values shape: [steps, tokens]; KL(step_i || step_{i-1}), None for the first step
+    v = np.clip(np.asarray(values, dtype=np.float64), EPS, None)
+    dist = np.clip(v / v.sum(axis=1, keepdims=True), EPS, 1.0)
+    log_dist = np.log(dist)
+    kl = (dist[1:] * (log_dist[1:] - log_dist[:-1])).sum(axis=1)
+    return [None, *kl.tolist()] if len(dist) else []
@@ -2,9 +2,13 @@ from __future__ import annotations
 
 import argparse
 import json
-import math
+import os
 from pathlib import Path
 
+import numpy as np
+
+from compression.serializer import ATTENTION_DTYPES, scan_file_sizes, valid_attention_scale
+
 
 REQUIRED_METADATA_KEYS = [
     "schema_version",
@@ -59,6 +63,9 @@ def validate(dataset_dir: Path) -> tuple[bool, list[str], list[str]]:
     if len(latent_pca.get("explained_variance_ratio", [])) != 2:
         errors.append("latent_pca.explained_variance_ratio must have exactly two values")
 
+    # Structural checks per entry; the byte-size arithmetic is done in one vectorized pass below.
+    file_sizes: dict[str, int | None] = {}
+    checked: list[tuple[int, str, list[int], int, int, int]] = []
     for idx, entry in enumerate(metadata.get("attention_files", [])):
         rel_path = entry.get("path")
         shape = entry.get("shape")
@@ -73,20 +80,70 @@ def validate(dataset_dir: Path) -> tuple[bool, list[str], list[str]]:
             errors.append(f"attention_files[{idx}] has non-positive shape dimensions")
             continue
 
-        file_path = dataset_dir / rel_path
-        if not file_path.exists():
+        dtype = entry.get("dtype", "float16")
+        if dtype not in ATTENTION_DTYPES:
+            errors.append(f"attention_files[{idx}] has unsupported dtype: {dtype}")
+            continue
+        itemsize = ATTENTION_DTYPES[dtype].itemsize
+        if dtype == "uint8":
+            if not valid_attention_scale(entry.get("attention_type"), shape, entry.get("scale")):
+                errors.append(f"attention_files[{idx}] is quantized but its scale is missing, non-positive or the wrong length")
+                continue
+
+        if rel_path not in file_sizes:
+            try:
+                file_sizes[rel_path] = os.stat(dataset_dir / rel_path).st_size
+            except OSError:
+                file_sizes[rel_path] = None
+        if file_sizes[rel_path] is None:
             errors.append(f"missing attention file: {rel_path}")
             continue
 
-        expected_items = math.prod(shape)
-        expected_bytes = expected_items * 2  # float16 byte size
-        actual_bytes = file_path.stat().st_size
-        if expected_bytes != actual_bytes:
-            errors.append(
-                f"attention size mismatch for {rel_path} (expected {expected_bytes} bytes, got {actual_bytes})"
-            )
-
-    size_mb = sum(path.stat().st_size for path in dataset_dir.rglob("*") if path.is_file()) / (1024 * 1024)
+        offset = entry.get("offset")
+        nbytes = entry.get("nbytes")
+        if offset is None:
+            # Legacy layout: one file per (layer, step).
+            offset = nbytes = -1
+        elif not isinstance(offset, int) or offset < 0 or not isinstance(nbytes, int):
+            errors.append(f"attention_files[{idx}] has invalid offset/nbytes")
+            continue
+        checked.append((idx, rel_path, shape, offset, nbytes, itemsize))
+
+    if checked:
+        rank = max(len(item[2]) for item in checked)
+        shapes = np.ones((len(checked), rank), dtype=np.int64)
+        for row, item in enumerate(checked):
+            shapes[row, : len(item[2])] = item[2]
+        itemsizes = np.fromiter((item[5] for item in checked), dtype=np.int64, count=len(checked))
+        expected = shapes.prod(axis=1) * itemsizes
+        file_bytes = np.fromiter((file_sizes[item[1]] for item in checked), dtype=np.int64, count=len(checked))
+        offsets = np.fromiter((item[3] for item in checked), dtype=np.int64, count=len(checked))
+        nbytes = np.fromiter((item[4] for item in checked), dtype=np.int64, count=len(checked))
+
+        legacy = offsets < 0
+        legacy_mismatch = legacy & (expected != file_bytes)
+        blob_mismatch = ~legacy & (expected != nbytes)
+        out_of_range = ~legacy & ~blob_mismatch & (offsets + nbytes > file_bytes)
+
+        for row in np.flatnonzero(legacy_mismatch | blob_mismatch | out_of_range):
+            idx, rel_path = checked[row][0], checked[row][1]
+            if legacy_mismatch[row]:
+                errors.append(
+                    f"attention size mismatch for {rel_path} "
+                    f"(expected {expected[row]} bytes, got {file_bytes[row]})"
+                )
+            elif blob_mismatch[row]:
+                errors.append(
+                    f"attention size mismatch for attention_files[{idx}] "
+                    f"(expected {expected[row]} bytes, got {nbytes[row]})"
+                )
+            else:
+                errors.append(
+                    f"attention_files[{idx}] range {offsets[row]}+{nbytes[row]} exceeds {rel_path} "
+                    f"size ({file_bytes[row]} bytes)"
+                )
+
+    size_mb = sum(scan_file_sizes(dataset_dir)) / (1024 * 1024)
     if size_mb > 200:
         warnings.append(f"dataset size is {size_mb:.2f}MB (>200MB)")
 
@@ -178,19 +178,26 @@ export function getAttentionEntry(dataset, attentionType, layerId, step) {
   return dataset.attentionLookup.get(`${attentionType}:${layerId}:${step}`) || null;
 }
 
-export async function getAttentionBuffer(dataset, path) {
+export async function getAttentionBuffer(dataset, path, offset = null, nbytes = null) {
   const normalizedPath = normalizePath(path);
-  if (dataset.attentionBufferCache.has(normalizedPath)) {
-    return dataset.attentionBufferCache.get(normalizedPath);
+  const hasRange = Number.isInteger(offset) && Number.isInteger(nbytes);
+  const cacheKey = hasRange ? `${normalizedPath}@${offset}` : normalizedPath;
+  if (dataset.attentionBufferCache.has(cacheKey)) {
+    return dataset.attentionBufferCache.get(cacheKey);
   }
 
-  const response = await fetch(`${dataset.baseUrl}/${normalizedPath}`, { cache: 'force-cache' });
+  const headers = hasRange ? { Range: `bytes=${offset}-${offset + nbytes - 1}` } : undefined;
+  const response = await fetch(`${dataset.baseUrl}/${normalizedPath}`, { cache: 'force-cache', headers });
   if (!response.ok) {
     throw new Error(`Failed to fetch attention asset: ${normalizedPath}`);
   }
-  const buffer = await response.arrayBuffer();
+  let buffer = await response.arrayBuffer();
+  if (hasRange && response.status !== 206) {
+    // Server ignored the Range header and returned the whole blob.
+    buffer = buffer.slice(offset, offset + nbytes);
+  }
 
-  setCacheWithLimit(dataset.attentionBufferCache, normalizedPath, buffer, ATTENTION_BUFFER_CACHE_LIMIT);
+  setCacheWithLimit(dataset.attentionBufferCache, cacheKey, buffer, ATTENTION_BUFFER_CACHE_LIMIT);
   return buffer;
 }
 